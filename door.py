@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import json
+import socket
 import time
 import logging
 import click
+from threading import Lock
 from gpiozero import Button
 import paho.mqtt.client as mqtt
 
@@ -11,6 +13,8 @@ mqtt_prefix = "homeassistant"
 
 debounce_time = 0.1
 
+reconcile_interval = 5
+
 
 class MQTTDevice:
     def __init__(self, device_name, mqtt_client: mqtt.Client):
@@ -24,23 +28,36 @@ class MQTTDevice:
                                "state_topic": self.state_topic, "availability_topic": self.availability_topic,
                                "payload_off": "off", "payload_on": "on"}
 
+        self._payload_on = b"on"
+        self._payload_off = b"off"
+        self._payload_online = b"online"
+        self._payload_offline = b"offline"
+        self._config_payload_bytes = json.dumps(self.config_payload).encode()
+
         self.state = None
 
+    def set_will(self):
+        self.mqtt_client.will_set(self.availability_topic, self._payload_offline, qos=1)
+
     def publish_availability(self, available: bool):
-        self.mqtt_client.publish(self.availability_topic, "online" if available else "offline", qos=1)
+        self.mqtt_client.publish(self.availability_topic, self._payload_online if available else self._payload_offline,
+                                 qos=1)
 
     def publish_state(self):
         if self.state is not None:
-            self.mqtt_client.publish(self.state_topic, "on" if self.state else "off", qos=1, retain=False)
+            self.mqtt_client.publish(self.state_topic, self._payload_on if self.state else self._payload_off, qos=0,
+                                     retain=True)
 
     def set_state(self, state: bool):
+        if state == self.state:
+            return
         self.state = state
         if self.mqtt_client.is_connected():
             self.publish_state()
 
     def on_connect(self):
-        self.mqtt_client.publish(self.config_topic, json.dumps(self.config_payload), qos=1)
-        self.mqtt_client.publish(self.availability_topic, "online", qos=1)
+        self.mqtt_client.publish(self.config_topic, self._config_payload_bytes, qos=1)
+        self.mqtt_client.publish(self.availability_topic, self._payload_online, qos=1)
         self.publish_state()
 
 
@@ -53,10 +70,7 @@ def main(host, credentials, verbose):
 
     logging.basicConfig(level=loglevel)
 
-    last_published_state = None
-    last_published_time = -float("inf")
-
-    reed = Button(23, pull_up=True)
+    reed = Button(23, pull_up=True, bounce_time=debounce_time)
 
     mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
@@ -68,7 +82,12 @@ def main(host, credentials, verbose):
         mqtt_client.username = credentials_dict["username"]
         mqtt_client.password = credentials_dict["password"]
 
-    mqtt_client.will_set(mqtt_sensor.availability_topic, "offline", qos=1)
+    mqtt_sensor.set_will()
+
+    def on_socket_open(_client: mqtt.Client, _userdata, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    mqtt_client.on_socket_open = on_socket_open
     mqtt_client.connect(host=host)
 
     def on_connect(_client: mqtt.Client, _userdata, _flags, reason_code, _properties):
@@ -79,17 +98,24 @@ def main(host, credentials, verbose):
 
     mqtt_client.loop_start()
 
-    while True:
-        state = not bool(reed.value)
-        if state != last_published_state:
-            if time.monotonic() > last_published_time + debounce_time:
+    # called from both the gpiozero callback thread and the reconcile loop below, the lock keeps a stale pin
+    # reading from being published after a newer one
+    reed_lock = Lock()
+
+    def on_reed_changed():
+        with reed_lock:
+            state = not reed.is_pressed  # the reed switch is closed (pressed) while the door is shut
+            if state != mqtt_sensor.state:
                 logging.info(f"New state: {state}")
-                mqtt_sensor.set_state(state)
-                last_published_time = time.monotonic()
-                last_published_state = state
-            else:
-                logging.debug(f"Debounce")
-        time.sleep(1 / 20)
+            mqtt_sensor.set_state(state)
+
+    reed.when_pressed = on_reed_changed
+    reed.when_released = on_reed_changed
+
+    # edges inside the bounce window are dropped, so reread the pin periodically to recover the final state
+    while True:
+        on_reed_changed()
+        time.sleep(reconcile_interval)
 
 
 if __name__ == "__main__":
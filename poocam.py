@@ -2,21 +2,25 @@
 import datetime
 import io
 import os
+import shutil
 import subprocess
-from threading import Thread
+from collections import deque
+from fractions import Fraction
+from threading import Event, Thread
 
+import av
 import click
+import cv2
 import numpy as np
 import time
-import queue
 import logging
 import signal
 
 from PyQt5.QtCore import Qt, QSize, QEvent, qDebug, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLabel, QPushButton, \
     QScrollArea, QFrame
-from PyQt5.QtGui import QCursor, QImage, QPainter, QColor
-from picamera2 import Picamera2
+from PyQt5.QtGui import QCursor
+from picamera2 import MappedArray, Picamera2
 from picamera2.previews.qt import QGlPicamera2
 from picamera2.encoders import H264Encoder
 from picamera2.outputs import FileOutput
@@ -29,36 +33,44 @@ from libcamera import controls
 poocam_config = {
     "video_width": 1280,
     "video_height": 720,
-    "low_res_width": 160,
-    "low_res_height": 120,
+    "low_res_width": 80,
+    "low_res_height": 60,
     "cut_left": 0.15,
     "cut_right": 0.20,
     "recording_timeout": 3,
+    "recording_motion_interval": 1 / 3,
     "recording_bitrate": 6_000_000,
 }
 
 
-def set_brightness(brightness: float):
-    with open("/sys/waveshare/rpi_backlight/brightness", "w+b") as brightness_device:
-        brightness_int = min(max(int((1 - brightness) * 255), 0), 255)
-        brightness_device.write(f"{brightness_int}".encode())
+brightness_path = "/sys/waveshare/rpi_backlight/brightness"
+
+
+def load_motion_mask(path: str) -> np.ndarray:
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise click.BadParameter(f"Could not read image {path}", param_hint="--motion-mask")
+    return mask
 
 
 class PoocamMainWindow(QMainWindow):
-    def __init__(self, temp_directory: str, target_directory: str, mse_threshold: float, screen_timeout: float):
+    def __init__(self, temp_directory: str, target_directory: str, pixel_threshold: int, motion_threshold: int,
+                 motion_mask: np.ndarray | None, screen_timeout: float):
         super().__init__()
         self._logger = logging.getLogger("Poocam")
         self.setWindowTitle("Poocam")
 
         self.temp_directory = temp_directory
         self.target_directory = target_directory
-        self.mse_threshold = mse_threshold
+        self.pixel_threshold = pixel_threshold
+        self.motion_threshold = motion_threshold
         self.current_filename: str | None = None
 
         self.screen_timeout = screen_timeout
         self.sleep_timer = QTimer(self)
         self.sleep_timer.setSingleShot(True)
         self.sleep_timer.timeout.connect(self.sleep)
+        self._brightness_fd: int | None = os.open(brightness_path, os.O_WRONLY)
 
         self.camera_scroll_widget = QScrollArea()
         self.camera_scroll_widget.setFrameShape(QFrame.NoFrame)
@@ -74,7 +86,8 @@ class PoocamMainWindow(QMainWindow):
 
         self._recording = False
         self._run = True
-        self._muxer_queue = queue.Queue()
+        self._muxer_queue: deque[str] = deque()
+        self._muxer_event = Event()
 
         self._logger.info(f"Screen size: {QApplication.primaryScreen().size()}")
 
@@ -82,6 +95,7 @@ class PoocamMainWindow(QMainWindow):
         self.camera_widget_width = int(
             screen_size.width() / (1 - (poocam_config["cut_left"] + poocam_config["cut_right"])))
         self.camera_widget_height = screen_size.height()
+        self._scroll_offset = int(poocam_config["cut_left"] * self.camera_widget_width)
 
         self._init_overlay()
 
@@ -94,6 +108,19 @@ class PoocamMainWindow(QMainWindow):
             lores={"size": (poocam_config["low_res_width"], poocam_config["low_res_height"]), "format": "YUV420"},
             controls={"FrameRate": 30.62})
         self.camera.configure(camera_config)
+
+        # libcamera may adjust the requested lores size without complaint, so size the detector by what it granted
+        lores_width, lores_height = self.camera.camera_config["lores"]["size"]
+        if (lores_width, lores_height) != (poocam_config["low_res_width"], poocam_config["low_res_height"]):
+            self._logger.warning(f"Lores size adjusted to {lores_width}x{lores_height}")
+        self._lores_shape = (lores_height, lores_width)
+        # previous frame, thresholded differences of the previous and current frame pairs, moving pixels
+        self._motion_buffers = np.zeros((4, *self._lores_shape), np.uint8)
+        if motion_mask is not None:
+            motion_mask = cv2.resize(motion_mask, (lores_width, lores_height), interpolation=cv2.INTER_AREA)
+            _, motion_mask = cv2.threshold(motion_mask, 127, 255, cv2.THRESH_BINARY)
+        self.motion_mask = motion_mask
+
         self.camera_widget = QGlPicamera2(self.camera, width=self.camera_widget_width,
                                           height=self.camera_widget_height, keep_ar=False)
         self.camera_scroll_widget.setWidget(self.camera_widget)
@@ -117,19 +144,28 @@ class PoocamMainWindow(QMainWindow):
     #     overlay_height = poocam_config["video_height"]
 
     def _init_overlay(self):
-        overlay = QImage(self.camera_widget_width, self.camera_widget_height, QImage.Format_RGBA8888)
-        overlay.fill(Qt.transparent)
-        painter = QPainter(overlay)
-        painter.setRenderHint(QPainter.Antialiasing, True)
-        # painter.setPen(QColor(255, 0, 0, 127))
-        painter.setBrush(QColor(255, 0, 0, 127))
         dot_size = 40
-        painter.drawEllipse(overlay.width() // 2 + 250 - dot_size // 2, overlay.height() // 2 - 250 + dot_size // 2,
-                            dot_size, dot_size)
-        painter.end()
-        ptr = overlay.bits()
-        ptr.setsize(overlay.width() * overlay.height() * 4)
-        self.overlay = np.copy(np.frombuffer(ptr, np.uint8).reshape((overlay.height(), overlay.width(), 4)))
+        radius = dot_size / 2
+        # QPainter's default 1 px black pen outlined the dot, the outline straddles the edge so pad by one pixel
+        size = dot_size + 2
+        left = self.camera_widget_width // 2 + 250 - dot_size // 2 - 1
+        top = self.camera_widget_height // 2 - 250 + dot_size // 2 - 1
+        y, x = np.ogrid[:size, :size]
+        distance = np.hypot(x + 0.5 - (radius + 1), y + 0.5 - (radius + 1))
+        fill = np.clip(radius + 0.5 - distance, 0, 1) * 127 / 255  # antialiased edge
+        outline = np.clip(1 - np.abs(distance - radius), 0, 1)
+        alpha = outline + fill * (1 - outline)  # opaque black outline over the translucent red fill
+        red = np.divide(255 * fill * (1 - outline), alpha, out=np.zeros_like(alpha), where=alpha > 0)
+        self.overlay = np.zeros((self.camera_widget_height, self.camera_widget_width, 4), np.uint8)
+        # clip the dot to the overlay like QPainter did, small screens push it past the top edge
+        clipped_top = min(max(top, 0), self.camera_widget_height)
+        clipped_left = min(max(left, 0), self.camera_widget_width)
+        clipped_bottom = max(min(top + size, self.camera_widget_height), clipped_top)
+        clipped_right = max(min(left + size, self.camera_widget_width), clipped_left)
+        crop = np.s_[clipped_top - top:clipped_bottom - top, clipped_left - left:clipped_right - left]
+        dot = self.overlay[clipped_top:clipped_bottom, clipped_left:clipped_right]
+        dot[..., 0] = red[crop]
+        dot[..., 3] = 255 * alpha[crop]
 
     def start_recording(self):
         self._recording = True
@@ -148,7 +184,8 @@ class PoocamMainWindow(QMainWindow):
             if self._pts_writer:
                 self._pts_writer.close()
             self.set_overlay(False)
-            self._muxer_queue.put(self.current_filename)
+            self._muxer_queue.append(self.current_filename)
+            self._muxer_event.set()
             self._recording = False
 
     def set_overlay(self, enabled: bool):
@@ -156,24 +193,29 @@ class PoocamMainWindow(QMainWindow):
 
     def resizeEvent(self, event):
         # self._logger.info(f"resize: {event.size()}")
-        self.camera_scroll_widget.horizontalScrollBar().setValue(
-            int(poocam_config["cut_left"] * self.camera_widget_width))
+        self.camera_scroll_widget.horizontalScrollBar().setValue(self._scroll_offset)
         QMainWindow.resizeEvent(self, event)
 
     # def mouseMoveEvent(self, event):
     #     self._logger.info(f"mouseMoveEvent {event.type()} {event.pos()}")
     #     event.accept()
 
+    def set_brightness(self, brightness: float):
+        if self._brightness_fd is None:
+            return
+        brightness_int = min(max(int((1 - brightness) * 255), 0), 255)
+        os.pwrite(self._brightness_fd, f"{brightness_int}".encode(), 0)
+
     def wake(self):
         self.camera_widget.show()
-        set_brightness(1)
+        self.set_brightness(1)
         self.preview_enabled = True
         if self.screen_timeout > 0:
             self.sleep_timer.start(self.screen_timeout * 1000)
 
     def sleep(self):
         self.camera_widget.hide()
-        set_brightness(0)
+        self.set_brightness(0)
         self.preview_enabled = False
 
     def mousePressEvent(self, event):
@@ -209,24 +251,43 @@ class PoocamMainWindow(QMainWindow):
         self._logger.info("Exiting")
         self.stop_recording()
         self._run = False
-        set_brightness(1)
+        self.sleep_timer.stop()
+        self.set_brightness(1)
+        if self._brightness_fd is not None:
+            os.close(self._brightness_fd)
+            self._brightness_fd = None
         time.sleep(1)
         event.accept()
 
     def motion_detector(self):
-        previous = None
+        lores_height, lores_width = self._lores_shape
+        # three-frame differencing: a pixel is moving only if it changed in both of the last two frame pairs,
+        # the thresholded difference of the current pair is kept and reused as the previous pair on the next frame
+        # all planes are views into one contiguous allocation, pixels outside the motion mask are never written
+        previous, diff_previous, diff_current, moving_pixels = self._motion_buffers
+        frames = 0
         last_activity = 0
         stabilized = False
         i = 0
         while self._run:
-            current = self.camera.capture_buffer("lores")
-            current = current[:poocam_config["low_res_width"] * poocam_config["low_res_height"]]. \
-                reshape(poocam_config["low_res_height"], poocam_config["low_res_width"])  # luminance
-            if previous is not None:
-                mse = np.square(np.subtract(current, previous)).mean()
-                if not stabilized and mse < self.mse_threshold:
+            # read the luminance plane straight from the camera buffer, which is returned to the pool on release
+            request = self.camera.capture_request()
+            try:
+                with MappedArray(request, "lores", write=False) as mapped:
+                    current = mapped.array[:lores_height, :lores_width]
+                    if frames >= 1:
+                        cv2.absdiff(current, previous, dst=diff_current)
+                    np.copyto(previous, current)
+            finally:
+                request.release()
+            if frames >= 1:
+                cv2.threshold(diff_current, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=diff_current)
+            if frames >= 2:
+                cv2.bitwise_and(diff_previous, diff_current, dst=moving_pixels, mask=self.motion_mask)
+                moving = cv2.countNonZero(moving_pixels)
+                if not stabilized and moving < self.motion_threshold:
                     stabilized = True
-                if stabilized and mse > self.mse_threshold:
+                if stabilized and moving > self.motion_threshold:
                     if not self._recording:
                         self.start_recording()
                     last_activity = time.monotonic()
@@ -234,24 +295,56 @@ class PoocamMainWindow(QMainWindow):
                     self.stop_recording()
                 i += 1
                 if i == 9:
-                    self._logger.debug(f"MSE: {mse}")
+                    self._logger.debug(f"Moving pixels: {moving}")
                     i = 0
-            previous = current
+                if self._recording:
+                    # only the end of motion is being watched for, so check a few times per second, each check
+                    # starts a new burst of three consecutive frames to keep the thresholds' frame spacing
+                    time.sleep(poocam_config["recording_motion_interval"])
+                    frames = 0
+            else:
+                frames += 1
+            diff_previous, diff_current = diff_current, diff_previous
         self._logger.info("Exiting motion detector")
 
+    @staticmethod
+    def _remux(h264_path: str, pts_path: str, mkv_path: str):
+        with io.open(pts_path) as pts_file:
+            timestamps = [float(line) for line in pts_file if line.strip() and not line.startswith("#")]  # ms
+        with av.open(h264_path, format="h264") as h264_container, \
+                av.open(mkv_path, "w", format="matroska") as mkv_container:
+            h264_stream = h264_container.streams.video[0]
+            if hasattr(mkv_container, "add_stream_from_template"):
+                mkv_stream = mkv_container.add_stream_from_template(h264_stream)
+            else:  # PyAV < 13.1
+                mkv_stream = mkv_container.add_stream(template=h264_stream)
+            frames = 0
+            for packet in h264_container.demux(h264_stream):
+                if not packet.size:
+                    continue
+                if frames == len(timestamps):
+                    raise ValueError(f"{h264_path} has more frames than the {len(timestamps)} timestamps in {pts_path}")
+                packet.pts = packet.dts = round(timestamps[frames] * 1000)
+                packet.time_base = Fraction(1, 1_000_000)
+                packet.stream = mkv_stream
+                mkv_container.mux(packet)
+                frames += 1
+            if frames != len(timestamps):
+                raise ValueError(f"{h264_path} has {frames} frames but {pts_path} has {len(timestamps)} timestamps")
+
     def muxer(self):
-        while self._run or not self._muxer_queue.empty():
-            try:
-                filename = self._muxer_queue.get(block=True, timeout=1)
-            except queue.Empty:
-                filename = None
-            if filename:
+        while self._run or self._muxer_queue:
+            self._muxer_event.wait(timeout=1)
+            self._muxer_event.clear()
+            while self._muxer_queue:
+                filename = self._muxer_queue.popleft()
                 mkv_path = os.path.join(self.temp_directory, f"{filename}.mkv")
                 pts_path = os.path.join(self.temp_directory, f"{filename}.txt")
                 h264_path = os.path.join(self.temp_directory, f"{filename}.h264")
-                result = subprocess.run(["mkvmerge", "-o", mkv_path, "--timecodes", f"0:{pts_path}", h264_path])
-                if result.returncode != 0:
-                    self._logger.error(f"Error while muxing {filename}")
+                try:
+                    self._remux(h264_path, pts_path, mkv_path)
+                except Exception:  # a single bad clip must not stop the muxer thread
+                    self._logger.exception(f"Error while muxing {filename}")
                     continue
                 self._logger.info(f"{filename} successfully muxed")
                 try:
@@ -263,7 +356,7 @@ class PoocamMainWindow(QMainWindow):
                 except OSError:
                     self._logger.error(f"Could not delete {pts_path}")
                 try:
-                    os.rename(mkv_path, os.path.join(self.target_directory, f"{filename}.mkv"))
+                    shutil.move(mkv_path, os.path.join(self.target_directory, f"{filename}.mkv"))
                 except OSError:
                     self._logger.error(f"Could not move {mkv_path}")
         self._logger.info("Exiting muxer")
@@ -272,11 +365,15 @@ class PoocamMainWindow(QMainWindow):
 @click.command()
 @click.option("--temp-directory", type=click.Path(exists=True, file_okay=False), default="temp")
 @click.option("--recordings-directory", type=click.Path(exists=True, file_okay=False), default="recordings")
-@click.option("--mse-threshold", type=float, default=6)
+@click.option("--pixel-threshold", type=int, default=15, help="Luminance change counted as a moving pixel")
+@click.option("--motion-threshold", type=int, default=24, help="Number of moving pixels that triggers recording")
+@click.option("--motion-mask", type=click.Path(exists=True, dir_okay=False),
+              help="Image whose black areas are ignored by the motion detector")
 @click.option("--screen-timeout", type=float, default=0)
 @click.option("-v", '--verbose', count=True, help="Logging level")
 @click.option("-l", "--log", is_flag=True, help="Enable logging to file")
-def main(temp_directory: str, recordings_directory, mse_threshold, screen_timeout, verbose, log):
+def main(temp_directory: str, recordings_directory, pixel_threshold, motion_threshold, motion_mask, screen_timeout,
+         verbose, log):
     log_handlers = [logging.StreamHandler()]
     log_level = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}.get(verbose, logging.WARNING)
     if log:
@@ -288,8 +385,9 @@ def main(temp_directory: str, recordings_directory, mse_threshold, screen_timeou
         format='%(asctime)s|%(levelname)s|%(name)s|%(message)s',
         datefmt='%Y-%m-%d %H:%M:%S')
 
-    subprocess.run(["sudo", "chown", f"{os.getlogin()}:{os.getlogin()}", "/sys/waveshare/rpi_backlight/brightness"],
-                   check=True)
+    mask = load_motion_mask(motion_mask) if motion_mask else None
+
+    subprocess.run(["sudo", "chown", f"{os.getlogin()}:{os.getlogin()}", brightness_path], check=True)
 
     app = QApplication([])
 
@@ -297,7 +395,8 @@ def main(temp_directory: str, recordings_directory, mse_threshold, screen_timeou
     QApplication.setOverrideCursor(cursor)
     QApplication.changeOverrideCursor(cursor)
 
-    window = PoocamMainWindow(temp_directory, recordings_directory, mse_threshold, screen_timeout)
+    window = PoocamMainWindow(temp_directory, recordings_directory, pixel_threshold, motion_threshold, mask,
+                              screen_timeout)
     window.showFullScreen()
 
     signal.signal(signal.SIGINT, lambda _signum, _frame: window.close())